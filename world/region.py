@@ -3,21 +3,133 @@ This module contains the RegionFile class.
 """
 
 import os
-from os import path
 import gzip
 import zlib
-import io
+import struct
 import numpy
 import math
 import bisect
-import arrow
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from . import nbt
 from . import chunk
 
-null_sector = bytes(4096)
+# ISA-L decompresses zlib and gzip data considerably faster than the standard library.
+# It's optional, so fall back on zlib and gzip if it isn't installed.
+# ISA-L raises its own exceptions, so _decompress translates them back into the standard library's.
+try:
+    from isal import isal_zlib as _zlib
+    from isal import igzip as _gzip
+    _isal_errors = (_zlib.error,)
+    _isal_eof_errors = (EOFError,)
+except ImportError:
+    _zlib = zlib
+    _gzip = gzip
+    _isal_errors = ()
+    _isal_eof_errors = ()
+# gzip.BadGzipFile was added in Python 3.8, before that gzip raised a plain OSError.
+_bad_gzip_error = getattr(gzip, 'BadGzipFile', OSError)
+
+# Precompiled formats for the entries in the offset and timestamp tables,
+# and for the length and compression type at the start of each chunk.
+_uint_format = struct.Struct('>I')
+_chunk_header_format = struct.Struct('>IB')
+_has_pread = hasattr(os, 'pread')
+_has_writev = hasattr(os, 'writev')
+_has_fadvise = hasattr(os, 'posix_fadvise')
+# The most buffers that a single call to os.writev will accept.
+# Ask the platform for IOV_MAX, and fall back on 1024 (its value on Linux and macOS) if it can't say.
+_iov_max = 1024
+if hasattr(os, 'sysconf') and 'SC_IOV_MAX' in os.sysconf_names:
+    try:
+        _iov_max = os.sysconf('SC_IOV_MAX')
+    except OSError:
+        pass
+    if _iov_max <= 0:
+        _iov_max = 1024
+# The most decompressed chunk data (in bytes) that a RegionFile will keep cached.
+chunk_cache_limit = 64 * 1024 * 1024
 
 __all__ = ['Sector', 'RegionFile']
 
+def _write_buffers(f, buffers : list):
+    """
+    Writes every buffer in `buffers` to `f`, one after the other.
+    Where os.writev is available the buffers are gathered into as few syscalls as possible,
+    otherwise they are written one at a time.
+    """
+    if not _has_writev:
+        f.writelines(buffers)
+        return
+    f.flush()
+    fd = f.fileno()
+    views = [memoryview(buff) for buff in buffers]
+    start = 0
+    while start < len(views):
+        written = os.writev(fd, views[start:start + _iov_max])
+        # writev is allowed to stop early, so skip past whatever made it out
+        # and trim the buffer that was only partially written.
+        while start < len(views) and written >= len(views[start]):
+            written -= len(views[start])
+            start += 1
+        if written > 0:
+            views[start] = views[start][written:]
+
+def _decompress(compression_type : int, data : bytes) -> bytes:
+    """
+    Decompresses chunk data according to its compression type.
+    Returns None if the compression type is unknown.
+    Corrupt data raises zlib.error or gzip.BadGzipFile, whether or not ISA-L is being used.
+    """
+    # 1 GZip, 2 Zlib, 3 uncompressed
+    if compression_type == 2:
+        try:
+            return _zlib.decompress(data)
+        except _isal_errors as e:
+            raise zlib.error(str(e)) from e
+    elif compression_type == 1:
+        try:
+            return _gzip.decompress(data)
+        except _isal_errors as e:
+            # gzip raises zlib.error for a corrupt deflate stream.
+            raise zlib.error(str(e)) from e
+        except _isal_eof_errors as e:
+            # ISA-L says data too short to hold the gzip magic number was cut off,
+            # where gzip says it isn't gzip data at all.
+            if data[:2] != b'\x1f\x8b':
+                raise _bad_gzip_error(f'Not a gzipped file ({bytes(data[:2])!r})') from e
+            raise
+    elif compression_type == 3:
+        return data
+
+def _location(offset : int, count : int) -> int:
+    """
+    Packs a sector offset and count into a single offset table entry.
+    The offset takes up 3 bytes and the count takes up 1, so an OverflowError is raised if either doesn't fit.
+    """
+    if not 0 <= offset < (1 << 24):
+        raise OverflowError(f'Sector offset {offset} does not fit in 3 bytes.')
+    if not 0 <= count <= 255:
+        raise OverflowError(f'Sector count {count} does not fit in 1 byte.')
+    return (offset << 8) | count
+
+def _preallocate(f, size : int):
+    """
+    Grows the file `f` to `size` bytes before it is written to.
+    posix_fallocate is used where it is available so that the filesystem can reserve the space in one go.
+    Otherwise the file is just truncated out to `size`.
+    """
+    f.flush()
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except OSError:
+            # Not every filesystem supports fallocate.
+            pass
+    f.truncate(size)
+
 class Sector(object):
     """
     An object that represents the area of the file that a chunk is located at.
@@ -48,12 +160,12 @@ class Sector(object):
         return self.offset * 4096
     
     def __lt__(self, other):
+        """
+        Sectors are ordered by their offset alone, so that any two sectors can be compared.
+        """
         if type(other) == Sector:
-            return (self.offset + self.count) <= other.offset
-    
-    def __gt__(self, other):
-        if type(other) == Sector:
-            return self.offset >= (other.offset + other.count)
+            return self.offset < other.offset
+        return NotImplemented
     
     def __eq__(self, other):
         if type(other) == Sector:
@@ -69,10 +181,11 @@ class Sector(object):
             return False
     
     def to_bytes(self):
-        with io.BytesIO() as buff:
-            buff.write(self.offset.to_bytes(3, 'big', signed=False))
-            buff.write(self.count.to_bytes(1, 'big', signed=False))
-            return buff.getvalue()
+        """
+        Returns the 4 byte entry for this sector in a region file's offset table.
+        Raises an OverflowError if the offset doesn't fit in 3 bytes or the count doesn't fit in 1.
+        """
+        return _uint_format.pack(_location(self.offset, self.count))
     
     def __repr__(self):
         return f'Sector(offset={self.offset}, count={self.count})'
@@ -87,7 +200,7 @@ class RegionFile:
     # putting each chunk into a seperate files for easy modification.
     # Once the user is done modifying the chunks, they can save them back into the region file.
 
-    __slots__ = ('filename','chunk_sectors','loaded_chunks','loaded_indices')
+    __slots__ = ('filename','loaded_chunks','loaded_indices','_fd','_size','_cache','_cache_size','_timestamp_table','_sec_offset','_sec_count','_chunk_sectors')
 
     @staticmethod
     def get_index(x : int, z : int):
@@ -111,25 +224,110 @@ class RegionFile:
 
     def __init__(self, filename : str):
         self.filename = filename
-        self.chunk_sectors = numpy.ndarray(shape=(1024), dtype=numpy.object_)
         self.loaded_chunks = dict()
         self.loaded_indices = set()
-        if not os.path.exists(self.filename):
-            raise FileNotFoundError(self.filename)
-        if path.isfile(filename):
-            with open(self.filename, 'rb') as f:
-                f.seek(0, os.SEEK_END)
-                size = f.tell()
-                f.seek(0)
-
-                for i in range(1024):
-                    offset = int.from_bytes(f.read(3), byteorder='big', signed=False)
-                    sector_count = int.from_bytes(f.read(1), byteorder='big', signed=False)
-                    if offset >= 2 and sector_count > 0:
-                        sector = Sector(offset, sector_count)
-                        self.chunk_sectors[i] = sector
-                    else:
-                        self.chunk_sectors[i] = None
+        self._fd = None
+        self._cache = OrderedDict()
+        self._cache_size = 0
+        # The offset and timestamp tables are kept in memory so that looking up a chunk doesn't touch the disk.
+        # The offset table is only kept decoded, as the `_sec_offset` and `_sec_count` arrays.
+        self._timestamp_table = bytearray(4096)
+        self._sec_offset = numpy.zeros(shape=(1024,), dtype=numpy.uint32)
+        self._sec_count = numpy.zeros(shape=(1024,), dtype=numpy.uint32)
+        # Opening the file raises FileNotFoundError if it doesn't exist, so there's no need to check first.
+        self._open()
+        # Read both tables at once, then decode the offset table with numpy.
+        # Each entry is a 3 byte offset followed by a 1 byte sector count.
+        # A file too small to hold full tables is treated as having no chunks past its end.
+        head = self._fd.read(8192)
+        self._decode_offset_table(head[:4096].ljust(4096, b'\x00'))
+        self._timestamp_table[:] = head[4096:].ljust(4096, b'\x00')
+    
+    @property
+    def chunk_sectors(self) -> list:
+        """
+        Returns a list with the Sector of every chunk index, or None where there is no chunk.
+        The list is built from the sector arrays the first time it's needed after the region file is loaded or saved.
+        Changing it doesn't affect the region file.
+        Use get_sector(...) to look up a single chunk without building the list.
+        """
+        if self._chunk_sectors is None:
+            sectors = [None] * 1024
+            for i in numpy.flatnonzero(self._sec_count).tolist():
+                sectors[i] = Sector(int(self._sec_offset[i]), int(self._sec_count[i]))
+            self._chunk_sectors = sectors
+        return self._chunk_sectors
+    
+    def get_sector(self, ind : int) -> Sector:
+        """
+        Returns the Sector of the chunk at `ind`, or None if there is no chunk there.
+        : int ind : A chunk index, see get_index(...).
+        """
+        count = int(self._sec_count[ind])
+        if count == 0:
+            return None
+        return Sector(int(self._sec_offset[ind]), count)
+    
+    def _decode_offset_table(self, offset_table : bytes):
+        """
+        Splits the offset table into two numpy arrays indexed by chunk index,
+        `_sec_offset` for the sector offsets and `_sec_count` for the sector counts.
+        Both are 0 for chunks that aren't in the region file.
+        These arrays are the only copy of the offset table that RegionFile keeps.
+        """
+        table = numpy.frombuffer(offset_table, dtype='>u4')
+        offsets = (table >> 8).astype(numpy.uint32)
+        counts = (table & 0xFF).astype(numpy.uint32)
+        present = (offsets >= 2) & (counts > 0)
+        self._sec_offset = numpy.where(present, offsets, 0)
+        self._sec_count = numpy.where(present, counts, 0)
+        # The chunk_sectors list is rebuilt from the new arrays the next time it's asked for.
+        self._chunk_sectors = None
+    
+    def _open(self):
+        """
+        Opens the region file and keeps the handle around so that reads don't have to reopen it.
+        The size of the file is cached so that reads can be checked against it without asking the disk.
+        """
+        self._fd = open(self.filename, 'rb')
+        self._size = os.fstat(self._fd.fileno()).st_size
+        # Chunks are read from all over the file, so readahead would only waste the page cache.
+        self._advise('POSIX_FADV_RANDOM')
+    
+    def _advise(self, advice : str):
+        """
+        Tells the kernel how the region file is about to be read, using posix_fadvise where it is available.
+        : str advice : The name of the POSIX_FADV_* constant in the os module.
+        """
+        if _has_fadvise:
+            os.posix_fadvise(self._fd.fileno(), 0, 0, getattr(os, advice))
+    
+    def _pread(self, size : int, offset : int) -> bytes:
+        """
+        Reads `size` bytes from the region file starting at `offset`.
+        This is a single positional read that doesn't touch the handle's file position,
+        so it takes one syscall instead of a seek and a read, and is safe to use from more than one thread.
+        """
+        if _has_pread:
+            return os.pread(self._fd.fileno(), size, offset)
+        # os.pread isn't available on Windows.
+        self._fd.seek(offset)
+        return self._fd.read(size)
+    
+    def close(self):
+        """
+        Closes the file handle for the region file.
+        The handle is kept around afterwards, so reading from a closed region file
+        raises ValueError('I/O operation on closed file.') just like any other closed file.
+        """
+        if self._fd is not None:
+            self._fd.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
     
     def save(self):
 
@@ -139,72 +337,101 @@ class RegionFile:
         When it encounters a chunk that has been loaded, it will write that chunk to the file instead
         of the data that is in the region file.
         """
-        if not os.path.isfile(self.filename):
-            raise FileNotFoundError(self.filename)
+        # Build the records for every dirty chunk up front.
+        # This way the size of the output file is known before anything is written to it.
+        records = dict()
+        dirty_chunks = []
+        for i in range(1024):
+            # Get the chunk coordinate from the index.
+            coord = RegionFile.expand_index(i)
+            # Try to get a loaded chunk with the coordinate.
+            loaded_chunk = self.loaded_chunks.get(coord, None)
+
+            if loaded_chunk is not None and loaded_chunk.isDirty:
+                # TODO: Eventually I plan on writing a save function for Chunk that doesn't require converting to NBT.
+                chunk_nbt = loaded_chunk.to_nbt()
+                chunk_data = zlib.compress(nbt.dump(chunk_nbt))
+                chunk_size = len(chunk_data)
+                # The 4 byte length and 1 byte compression type come before the data,
+                # and the whole record is padded out to a multiple of 4096 bytes.
+                # The record is built in memory as a single sector aligned buffer.
+                record = bytearray(((chunk_size + 5 + 4095) // 4096) * 4096)
+                _chunk_header_format.pack_into(record, 0, chunk_size + 1, 2)
+                record[5:5 + chunk_size] = chunk_data
+                if len(record) // 4096 > 255:
+                    # The offset table only has a single byte for the sector count.
+                    # Fail here, before anything is written, so the region file is left as it was.
+                    raise OverflowError(f'Chunk {coord} needs {len(record) // 4096} sectors, but at most 255 fit in a region file.')
+                records[i] = record
+                # The cached data for this chunk won't match what gets saved.
+                self._uncache(i)
+                dirty_chunks.append(loaded_chunk)
+        # Lay out the new file in memory before writing any of it.
+        # The first two sectors are where sector information and timestamps are stored.
+        # Chunks keep their index, so their timestamps are carried over as they are,
+        # except for dirty chunks which are stamped with the current time.
+        offset_table = bytearray(4096)
+        timestamp_table = bytearray(self._timestamp_table)
+        now = int(time.time())
+        for i in records:
+            _uint_format.pack_into(timestamp_table, i * 4, now)
+        buffers = [offset_table, timestamp_table]
+        offset = 2
+
+        # Copy the chunks in the order that they are laid out in the region file.
+        # That way the region file is read from front to back instead of jumping around.
+        # The order comes from a single argsort over the sector offsets.
+        present = numpy.flatnonzero(self._sec_count)
+        order = present[numpy.argsort(self._sec_offset[present], kind='stable')].tolist()
+        # Any dirty chunk that isn't in the region file yet goes at the end.
+        order.extend(i for i in records if self._sec_count[i] == 0)
+        sec_offsets = self._sec_offset.tolist()
+        sec_counts = self._sec_count.tolist()
+        self._advise('POSIX_FADV_SEQUENTIAL')
+        try:
+            for i in order:
+                record = records.get(i, None)
+                if record is None:
+                    # The chunk hasn't been loaded, so we'll just copy it from the region file.
+                    # A sector cut short by the end of the file is padded so the layout stays aligned.
+                    size = sec_counts[i] * 4096
+                    record = self._pread(size, sec_offsets[i] * 4096).ljust(size, b'\x00')
+                count = len(record) // 4096
+                _uint_format.pack_into(offset_table, i * 4, _location(offset, count))
+                buffers.append(record)
+                offset += count
+        except BaseException:
+            # The save failed, so this handle stays open and later reads go back to being random.
+            self._advise('POSIX_FADV_RANDOM')
+            raise
+        finally:
+            # Everything has been read from the region file now, so its pages can be dropped from the cache.
+            # If the file gets replaced, the new handle is advised when it is opened.
+            self._advise('POSIX_FADV_DONTNEED')
+
         # Create temporary output file to write to.
         output_path = self.filename + '.out'
         with open(output_path, 'wb') as outfile:
-            # Open the region file that this instance points to.
-            with open(self.filename, 'rb') as infile:
-                # First write 8192 bytes to the file.
-                # This is where sector information and timestamps are stored.
-                outfile.write(null_sector)
-                outfile.write(null_sector)
-                # First write all the chunk data while saving the sector information.
-                # After writing all the chunk data, seek to the beginning of the file and write the header data.
-                new_sectors = numpy.ndarray(shape=(1024,), dtype=numpy.object_)
-
-                # Loop through the 1024 possible chunks and write them to the file if they exist in some manner.
-                for i in range(1024):
-                    # Define a sector that this chunk will potentially take up.
-                    # The new sector will be (0,0) because we are not guaranteed
-                    # to have chunk data.
-                    new_sect = Sector(0,0)
-                    # Set the new sector's offset according to the output file's offset divided by 4096.
-                    new_sect.offset = outfile.tell() // 4096
-                    # Get the chunk coordinate from the index.
-                    coord = RegionFile.expand_index(i)
-                    # Try to get a loaded chunk with the coordinate.
-                    loaded_chunk = self.loaded_chunks.get(coord, None)
-                    
-                    if loaded_chunk is not None and loaded_chunk.isDirty:
-                        # TODO: Eventually I plan on writing a save function for Chunk that doesn't require converting to NBT.
-                        chunk_nbt = loaded_chunk.to_nbt()
-                        chunk_data = zlib.compress(nbt.dump(chunk_nbt))
-                        chunk_size = len(chunk_data)
-                        data_length = chunk_size + 1
-                        total_size = chunk_size + 5
-                        pad_size = 0 if ((total_size) % 4096) == 0 else (4096 - (total_size % 4096))
-                        padded_size = total_size + pad_size
-                        new_sect.count = padded_size // 4096
-                        outfile.write(data_length.to_bytes(4, 'big', signed=False))
-                        outfile.write(b'\x02')
-                        outfile.write(chunk_data)
-                        outfile.write(bytes(pad_size))
-                        loaded_chunk.isDirty = False
-                    else:
-                        # The chunk hasn't been loaded, so we'll just write it from the infile.
-                        sect = self.chunk_sectors[i]
-                        if sect is not None:
-                            infile.seek(sect.offset * 4096)
-                            outfile.write(infile.read(4096 * sect.count))
-                            new_sect.count = sect.count
-                        else:
-                            new_sect.offset = 0
-                            new_sect.count = 0
-                    new_sectors[i] = new_sect if new_sect.count > 0 and new_sect.offset >= 2 else None
-                self.chunk_sectors = new_sectors
-                # Now we will write the sector information to the file.
-                outfile.seek(0)
-                null_data4 = b'\x00\x00\x00\x00'
-                for i in range(1024):
-                    if new_sectors[i] is not None:
-                        outfile.write(new_sectors[i].offset.to_bytes(3, 'big', signed=False))
-                        outfile.write(new_sectors[i].count.to_bytes(1, 'big', signed=False))
-                    else:
-                        outfile.write(null_data4)
+            # Reserve the space for the whole file at once rather than growing it one write at a time.
+            _preallocate(outfile, offset * 4096)
+            # Hand all of the buffers to the kernel in as few calls as possible.
+            _write_buffers(outfile, buffers)
+            # Make sure the new file is actually on disk before it replaces the original.
+            # Otherwise a crash right after the swap can leave behind an empty or truncated region file.
+            outfile.flush()
+            os.fsync(outfile.fileno())
         # Now we are done writing to the output file, so we will swap it with the original.
-        os.replace(output_path, self.filename)
+        # The old handle still points at the replaced file, so it must be reopened.
+        # It's reopened even if the swap fails, so the region file can still be read afterwards.
+        self.close()
+        try:
+            os.replace(output_path, self.filename)
+        finally:
+            self._open()
+        self._decode_offset_table(offset_table)
+        self._timestamp_table = timestamp_table
+        for loaded_chunk in dirty_chunks:
+            loaded_chunk.isDirty = False
 
     def read_chunk(self, offsetX : int, offsetZ : int) -> chunk.Chunk:
         if (offsetX, offsetZ) in self.loaded_chunks:
@@ -216,63 +443,148 @@ class RegionFile:
             self.loaded_indices.add(RegionFile.get_index(offsetX, offsetZ))
             return ch
     
+    def read_chunks_batch(self, coords) -> list:
+        """
+        Reads many chunks at once and returns a list of Chunks in the same order as `coords`.
+        Chunks that don't exist in the region file are None in the list.
+        Decompression is spread across a thread pool since zlib releases the GIL while it inflates.
+        Parsing the NBT still happens on this thread, while the rest of the chunks are decompressed.
+        : coords : An iterable of (offsetX, offsetZ) tuples.
+        """
+        coords = list(coords)
+        # Find every chunk that isn't already loaded or cached.
+        wanted = []
+        seen = set()
+        for offsetX, offsetZ in coords:
+            if (offsetX, offsetZ) in self.loaded_chunks:
+                continue
+            ind = ((offsetX & 31) + (offsetZ & 31) * 32)
+            if ind in self._cache or ind in seen or self._sec_count[ind] == 0:
+                continue
+            seen.add(ind)
+            wanted.append((offsetX, offsetZ, ind))
+        # Read their compressed data in the order it is laid out in the region file,
+        # so the file is read from front to back instead of jumping around.
+        wanted.sort(key=lambda item: self._sec_offset[item[2]])
+        pending = []
+        # There's no need to advise the kernel when there's nothing to read.
+        if wanted:
+            self._advise('POSIX_FADV_SEQUENTIAL')
+            try:
+                for offsetX, offsetZ, ind in wanted:
+                    compressed = self._read_compressed(ind)
+                    if compressed is not None:
+                        pending.append((offsetX, offsetZ, ind, compressed))
+            finally:
+                # The data has all been read now, so its pages can be dropped from the cache,
+                # and later reads go back to being random.
+                self._advise('POSIX_FADV_DONTNEED')
+                self._advise('POSIX_FADV_RANDOM')
+
+        # A thread pool is only worth starting up when there is more than one chunk to decompress.
+        pool = None
+        if len(pending) > 1:
+            pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+            decompressed = pool.map(lambda item: _decompress(*item[3]), pending)
+        else:
+            decompressed = (_decompress(*item[3]) for item in pending)
+        try:
+            # The results come back in order, so each chunk is parsed as soon as it is ready.
+            for (offsetX, offsetZ, ind, _), data in zip(pending, decompressed):
+                if data is None:
+                    continue
+                self._cache_put(ind, data)
+                ch = chunk.Chunk(nbt.load(data)[0])
+                self.loaded_chunks[offsetX, offsetZ] = ch
+                self.loaded_indices.add(RegionFile.get_index(offsetX, offsetZ))
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        # Every chunk that exists has been loaded by now, so this just collects them in order.
+        return [self.read_chunk(offsetX, offsetZ) for offsetX, offsetZ in coords]
+    
     def unload_chunk(self, offsetX : int, offsetZ : int) -> None:
         if (offsetX, offsetZ) in self.loaded_chunks:
             del self.loaded_chunks[offsetX, offsetZ]
     
+    def _read_compressed(self, ind : int) -> tuple:
+        """
+        Reads the chunk at `ind` without decompressing it.
+        Returns a tuple with the order of (compression_type, data), or None if there is no chunk there.
+        """
+        chunk_offset = int(self._sec_offset[ind])
+        if chunk_offset == 0:
+            return None
+        start = chunk_offset * 4096
+        if start + 5 > self._size:
+            # The offset points past the end of the file.
+            return None
+        data_length, compression_type = _chunk_header_format.unpack(self._pread(5, start))
+        if data_length < 1 or start + 4 + data_length > self._size:
+            # There's no data, or the data runs past the end of the file.
+            return None
+        return compression_type, self._pread(data_length-1, start + 5)
+
+    def _read_chunk_bytes(self, ind : int) -> bytes:
+        """
+        Returns the decompressed data of the chunk at `ind`, or None if there is no chunk there.
+        Recently read chunks are kept in a least recently used cache, so reading the
+        same chunk again skips both the disk and decompression.
+        """
+        data = self._cache.get(ind, None)
+        if data is not None:
+            self._cache.move_to_end(ind)
+            return data
+        compressed = self._read_compressed(ind)
+        if compressed is None:
+            return None
+        data = _decompress(*compressed)
+        if data is not None:
+            self._cache_put(ind, data)
+        return data
+    
+    def _cache_put(self, ind : int, data : bytes):
+        """
+        Adds the decompressed data of the chunk at `ind` to the cache,
+        evicting the least recently used chunks if the cache grows past chunk_cache_limit.
+        """
+        self._uncache(ind)
+        self._cache[ind] = data
+        self._cache_size += len(data)
+        while self._cache_size > chunk_cache_limit:
+            _, old_data = self._cache.popitem(last=False)
+            self._cache_size -= len(old_data)
+    
+    def _uncache(self, ind : int):
+        """
+        Drops the chunk at `ind` from the cache, if it's there.
+        """
+        data = self._cache.pop(ind, None)
+        if data is not None:
+            self._cache_size -= len(data)
+
     # TODO: Determine if this function is necessary, or if it can be moved into read_chunk(...)
     def read_chunk_tag(self, offsetX : int, offsetZ : int) -> nbt.nbt_tag:
         """
         Reads the chunk (decompressed) from the region file and returns the NBT.
         """
-        if not os.path.exists(self.filename):
-            raise FileNotFoundError(self.filename)
-        decompressed_data = None
-        ind = ((offsetX & 31) + (offsetZ & 31) * 32)
-
-        with open(self.filename,'rb') as f:
-            f.seek(ind * 4)
-            chunk_offset = int.from_bytes(f.read(3),'big')
-            if chunk_offset == 0:
-                return None
-            f.seek(chunk_offset * 4096)
-            data_length = int.from_bytes(f.read(4),'big')
-            compression_type = int.from_bytes(f.read(1),'big')
-            # 1 GZip, 2 Zlib, 3 uncompressed
-            if compression_type == 2:
-                return nbt.load(zlib.decompress(f.read(data_length-1)))
-            elif compression_type == 1:
-                return nbt.load(gzip.decompress(f.read(data_length-1)))
-            elif compression_type == 3:
-                return nbt.load(f.read(data_length-1))
+        data = self._read_chunk_bytes((offsetX & 31) + (offsetZ & 31) * 32)
+        if data is not None:
+            return nbt.load(data)
 
     # TODO: Determine if this function is necessary.
     def read_chunk_raw(self, offsetX : int, offsetZ : int) -> bytes:
-        if not os.path.exists(self.filename):
-            raise FileNotFoundError(self.filename)
-        decompressed_data = None
+        return self._read_chunk_bytes((offsetX & 31) + (offsetZ & 31) * 32)
+    
+    def read_timestamp(self, offsetX : int, offsetZ : int) -> int:
+        """
+        Returns the time that the chunk was last saved, in seconds since the epoch.
+        This will be 0 if the chunk has never been saved.
+        """
         ind = ((offsetX & 31) + (offsetZ & 31) * 32)
-
-        with open(self.filename,'rb') as f:
-            f.seek(ind * 4)
-            chunk_offset = int.from_bytes(f.read(3),'big')
-            if chunk_offset == 0:
-                return
-            f.seek(chunk_offset * 4096)
-            data_length = int.from_bytes(f.read(4),'big')
-            compression_type = int.from_bytes(f.read(1),'big')
-            # 1 GZip, 2 Zlib, 3 uncompressed
-            if compression_type == 2:
-                return zlib.decompress(f.read(data_length-1))
-            elif compression_type == 1:
-               return gzip.decompress(f.read(data_length-1))
-            elif compression_type == 3:
-                return f.read(data_length-1)
+        return _uint_format.unpack_from(self._timestamp_table, ind * 4)[0]
     
     def has_chunk(self, offsetX : int, offsetZ : int) -> bool:
-        if not os.path.exists(self.filename):
-            raise FileNotFoundError(self.filename)
-        ind = ((offsetX & 31) + (offsetZ & 31) * 32)
-        with open(self.filename, 'rb') as f:
-            f.seek(ind * 4)
-            return int.from_bytes(f.read(4), 'big') != 0
\ No newline at end of file
+        # The sector arrays always match the offset table on disk, so there's no need to read it.
+        return bool(self._sec_count[((offsetX & 31) + (offsetZ & 31) * 32)])